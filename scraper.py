@@ -1,42 +1,92 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import asyncio
+import atexit
 import time
-import csv
 import json
 from datetime import datetime, timedelta, timezone
 import logging
 import os
-from typing import Dict, Any, Optional
+import queue
+import signal
+import threading
+from typing import Dict, Any, List, Optional
+from urllib.parse import urlencode
 import browser_cookie3
 
+# orjson is optional - fall back to the stdlib parser if it isn't installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 class SensorAPIMonitor:
-    def __init__(self, output_file: str = "sensor_data.csv", original_length_mm: float = 100.0):
+    def __init__(self, output_file: str = "sensor_data.csv", original_length_mm: float = 100.0,
+                 activity_id: str = "t193_creep_capture", experiment_start: Optional[datetime] = None):
         self.api_url = "https://learn5.open.ac.uk/mod/htmlactivity/api/service.php"
         self.output_file = output_file
         self.original_length_mm = original_length_mm  # Original specimen length in mm
+        self._inv_length_pct = 100.0 / original_length_mm  # Strain % per mm of extension
         
-        # Experiment start time: 11th August 2025 at 12pm BST
+        # Experiment start time (timezone-aware), defaults to 11th August 2025 at 12pm BST
         # BST is UTC+1, so 12pm BST = 11am UTC
-        self.experiment_start = datetime(2025, 8, 11, 11, 0, 0, tzinfo=timezone.utc)
+        if experiment_start is None:
+            experiment_start = datetime(2025, 8, 11, 11, 0, 0, tzinfo=timezone.utc)
+        self.experiment_start = experiment_start
+        self._exp_start_ts = self.experiment_start.timestamp()
+        self._bst = timezone(timedelta(hours=1))
         
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36',
             'Content-Type': 'application/x-www-form-urlencoded',
             'Accept': 'application/json, text/javascript, */*; q=0.01',
-            'X-Requested-With': 'XMLHttpRequest'
+            'X-Requested-With': 'XMLHttpRequest',
+            'Connection': 'keep-alive'
         })
         
+        # Single pooled connection kept alive between polls, with backoff on gateway errors.
+        # POST is safe to retry here as getUpdate is read-only
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504],
+                      allowed_methods=frozenset(['POST']))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retry)
+        self.session.mount('https://', adapter)
+        
         # Form data for the API request
         self.form_data = {
             'a': 'default',
             'c': '3',
-            'i': 't193_creep_capture',
+            'i': activity_id,
             's': 'yWYFUnYGAQ',  # This might need to be extracted from cookies
             'x': 'service',
             'service': 'creep',
             'names': 'action',
             'values': 'getUpdate'
         }
+        # Pre-encoded POST body, rebuilt only when the session key changes
+        self._form_body = urlencode(self.form_data).encode('ascii')
+        
+        # Cookie refresh state - re-reading the Chrome cookie DB is expensive,
+        # so only do it hourly or after an auth/request failure
+        self._last_cookie_refresh = 0
+        self._cookie_refresh_interval = 3600  # seconds
+        self._force_cookie_refresh = False
+        
+        # Response body buffer reused across polls
+        self._resp_buf = bytearray()
+        
+        # Constant fields of the record written when an API call fails
+        self._err_template = {
+            'date': '',
+            'elapsed_seconds': 0,
+            'change_in_length_mm': 0.000,
+            'strain_percent': 0.000,
+            'running': False,
+            'temperature': 0,
+            'status_code': ''
+        }
         
         # Set up logging
         logging.basicConfig(
@@ -50,18 +100,33 @@ class SensorAPIMonitor:
         self.logger = logging.getLogger(__name__)
         
         # Load cookies for authentication
-        self.load_chrome_cookies()
+        self._refresh_cookies(force=True)
         
-        # Initialize CSV file
+        # Initialize CSV file - an append-only descriptor kept open for the whole
+        # run; rows are buffered in memory and written in batches with a single os.write
         self.init_csv_file()
+        self._pending_rows = []
+        self._csv_flush_rows = 10
+        
+        # Disk writes happen on a dedicated thread so a slow sync never delays a poll
+        self._write_queue = queue.SimpleQueue()
+        self._writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer_thread.start()
+        self._closed = False
+        atexit.register(self.close)
+        
+    def _refresh_cookies(self, force: bool = False):
+        """Load authentication cookies from Chrome for the OU domain unless the cached copy is still fresh"""
+        if (not force and not self._force_cookie_refresh
+                and time.time() - self._last_cookie_refresh < self._cookie_refresh_interval):
+            return
+        
+        self._last_cookie_refresh = time.time()
+        self._force_cookie_refresh = False
         
-    def load_chrome_cookies(self):
-        """Load authentication cookies from Chrome for the OU domain"""
         try:
-            # Get all OU-related cookies
-            all_chrome_cookies = browser_cookie3.chrome()
-            ou_cookies = [cookie for cookie in all_chrome_cookies 
-                         if 'open.ac.uk' in cookie.domain.lower()]
+            # Get all OU-related cookies (filtered in the cookie DB query)
+            ou_cookies = browser_cookie3.chrome(domain_name='open.ac.uk')
             
             cookie_count = 0
             session_key = None
@@ -79,85 +144,56 @@ class SensorAPIMonitor:
                 # Look for session key in cookie names/values
                 if 'session' in cookie.name.lower() or cookie.name == 's':
                     session_key = cookie.value
-                    self.logger.info(f"Found potential session key: {session_key}")
                 
             self.logger.info(f"Loaded {cookie_count} OU cookies")
             
             # Update session key in form data if found
-            if session_key:
+            if not session_key:
+                self.logger.warning("No session key found in cookies - using current key")
+            elif session_key != self.form_data.get('s'):
+                self.logger.info(f"Session key updated: {self.form_data.get('s')} -> {session_key}")
                 self.form_data['s'] = session_key
-                self.logger.info("Updated API session key from cookies")
+                self._form_body = urlencode(self.form_data).encode('ascii')
             else:
-                self.logger.warning("No session key found in cookies - using default")
+                self.logger.debug("Session key unchanged")
                 
         except Exception as e:
             self.logger.error(f"Error loading cookies: {e}")
-            self.logger.info("Continuing with default session key")
+            self.logger.info("Continuing with current session key")
     
     def init_csv_file(self):
-        """Initialize CSV file with headers"""
-        if not os.path.exists(self.output_file):
-            with open(self.output_file, 'w', newline='', encoding='utf-8') as file:
-                writer = csv.writer(file)
-                writer.writerow([
-                    'Date', 
-                    'Elapsed Time (s)',
-                    'Change in Length (mm)', 
-                    '% Strain'
-                ])
-    
-    def update_session_key_from_cookies(self):
-        """Update session key from Chrome cookies before each API request"""
-        try:
-            # Get fresh cookies from Chrome
-            all_chrome_cookies = browser_cookie3.chrome()
-            ou_cookies = [cookie for cookie in all_chrome_cookies 
-                         if 'open.ac.uk' in cookie.domain.lower()]
-            
-            session_key_updated = False
-            
-            for cookie in ou_cookies:
-                # Update all cookies in session
-                self.session.cookies.set(
-                    cookie.name, 
-                    cookie.value, 
-                    domain=cookie.domain, 
-                    path=cookie.path if cookie.path else '/'
-                )
-                
-                # Look for session key and update form data
-                if 'session' in cookie.name.lower() or cookie.name == 's':
-                    if cookie.value != self.form_data.get('s'):
-                        self.logger.info(f"Session key updated: {self.form_data.get('s')} -> {cookie.value}")
-                        self.form_data['s'] = cookie.value
-                        session_key_updated = True
-            
-            if not session_key_updated:
-                self.logger.debug("Session key unchanged")
-                
-        except Exception as e:
-            self.logger.warning(f"Error updating cookies: {e}")
+        """Open CSV file for appending, writing headers if it is empty"""
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, 'O_BINARY', 0)
+        self._fd = os.open(self.output_file, flags, 0o644)
+        # Checking the open descriptor avoids a separate exists() check and its race
+        if os.fstat(self._fd).st_size == 0:
+            os.write(self._fd, b"Date,Elapsed Time (s),Change in Length (mm),% Strain\r\n")
     
     def fetch_sensor_data(self) -> Optional[Dict[str, Any]]:
         """Fetch sensor data from the API endpoint"""
         try:
-            # Refresh cookies before each request
-            self.update_session_key_from_cookies()
+            # Refresh cookies if stale or a previous request failed
+            self._refresh_cookies()
             
-            response = self.session.post(self.api_url, data=self.form_data, timeout=10)
-            response.raise_for_status()
-            response.raise_for_status()
+            # Stream the body into the reused buffer; closing the response
+            # returns the connection to the pool even if the status check fails
+            with self.session.post(self.api_url, data=self._form_body, timeout=10, stream=True) as response:
+                response.raise_for_status()
+                
+                buf = self._resp_buf
+                buf.clear()
+                for chunk in response.iter_content(4096):
+                    buf.extend(chunk)
             
             # Parse JSON response
-            json_data = response.json()
+            json_data = json_loads(buf)
             
             if 'ok' in json_data and 'data' in json_data['ok']:
                 sensor_data = json_data['ok']['data']
                 current_time = datetime.now(timezone.utc)
                 
                 # Calculate actual elapsed time since experiment start (12pm BST on 11th Aug 2025)
-                elapsed_timedelta = current_time - self.experiment_start
-                calculated_elapsed_seconds = int(elapsed_timedelta.total_seconds())
+                calculated_elapsed_seconds = int(current_time.timestamp() - self._exp_start_ts)
                 
                 # Get raw elapsed value from API for comparison
                 api_elapsed_raw = sensor_data.get('elapsed', 0)
@@ -167,10 +203,10 @@ class SensorAPIMonitor:
                 change_in_length = round(extension_mm, 3)  # Round to 3 decimal places
                 
                 # Calculate strain percentage
-                strain_percent = round((change_in_length / self.original_length_mm) * 100, 3)
+                strain_percent = round(change_in_length * self._inv_length_pct, 3)
                 
                 # Format date as DD/MM
-                current_time_bst = current_time.replace(tzinfo=timezone.utc).astimezone(timezone(timedelta(hours=1)))  # Convert to BST
+                current_time_bst = current_time.astimezone(self._bst)  # Convert to BST
                 date_formatted = current_time_bst.strftime("%d/%m")
                 
                 data = {
@@ -183,101 +219,174 @@ class SensorAPIMonitor:
                     'status_code': response.status_code
                 }
                 
-                self.logger.info(f"API Success - Temp: {data['temperature']:.1f}°C, Length: {change_in_length}mm, Strain: {strain_percent}%, Elapsed: {calculated_elapsed_seconds}s")
+                self.logger.info("[%s] API Success - Temp: %.1f°C, Length: %smm, Strain: %s%%, Elapsed: %ss",
+                                 self.form_data['i'], data['temperature'], change_in_length, strain_percent, calculated_elapsed_seconds)
                 return data
             else:
-                self.logger.error(f"Unexpected API response format: {json_data}")
+                self.logger.error(f"[{self.form_data['i']}] Unexpected API response format: {json_data}")
+                # An expired session key can come back as a 200 with an error body
+                self._force_cookie_refresh = True
                 return self.create_error_record("API_FORMAT_ERROR")
                 
         except requests.exceptions.RequestException as e:
-            self.logger.error(f"API request failed: {e}")
+            self.logger.error(f"[{self.form_data['i']}] API request failed: {e}")
+            # Covers 401/403 via raise_for_status - re-read cookies next poll
+            self._force_cookie_refresh = True
             return self.create_error_record("REQUEST_ERROR")
         except json.JSONDecodeError as e:
-            self.logger.error(f"Failed to parse JSON response: {e}")
+            self.logger.error(f"[{self.form_data['i']}] Failed to parse JSON response: {e}")
             return self.create_error_record("JSON_ERROR")
         except Exception as e:
-            self.logger.error(f"Error fetching sensor data: {e}")
+            self.logger.error(f"[{self.form_data['i']}] Error fetching sensor data: {e}")
             return self.create_error_record("FETCH_ERROR")
     
     def create_error_record(self, error_type: str) -> Dict[str, Any]:
         """Create error record for failed API calls"""
         current_time = datetime.now(timezone.utc)
-        elapsed_timedelta = current_time - self.experiment_start
-        calculated_elapsed_seconds = int(elapsed_timedelta.total_seconds())
+        calculated_elapsed_seconds = int(current_time.timestamp() - self._exp_start_ts)
         
-        return {
-            'date': current_time.replace(tzinfo=timezone.utc).astimezone(timezone(timedelta(hours=1))).strftime("%d/%m"),
-            'elapsed_seconds': calculated_elapsed_seconds,
-            'change_in_length_mm': 0.000,
-            'strain_percent': 0.000,
-            'running': False,
-            'temperature': 0,
-            'status_code': f"ERROR_{error_type}"
-        }
+        record = self._err_template.copy()
+        record['date'] = current_time.astimezone(self._bst).strftime("%d/%m")
+        record['elapsed_seconds'] = calculated_elapsed_seconds
+        record['status_code'] = f"ERROR_{error_type}"
+        return record
     
     def save_data(self, data: Dict[str, Any]):
-        """Save sensor data to CSV"""
+        """Queue sensor data to be saved to CSV by the writer thread"""
+        if self._closed:
+            # No writer thread is left to drain the queue, so the row would be lost
+            self.logger.error(f"Error saving data: {self.output_file} is closed, dropping row {data}")
+            return
         try:
-            with open(self.output_file, 'a', newline='', encoding='utf-8') as file:
-                writer = csv.writer(file)
-                writer.writerow([
-                    data['date'],
-                    data['elapsed_seconds'],
-                    data['change_in_length_mm'],
-                    data['strain_percent']
-                ])
+            # Fields never need CSV quoting, so format the row directly
+            line = f"{data['date']},{data['elapsed_seconds']},{data['change_in_length_mm']:.3f},{data['strain_percent']:.3f}\r\n"
+            self._write_queue.put(line)
         except Exception as e:
             self.logger.error(f"Error saving data: {e}")
     
-    def run_for_duration(self, days: int = 7, interval_seconds: int = 30):
-        """Run the sensor monitor for specified duration"""
-        start_time = datetime.now()
-        end_time = start_time + timedelta(days=days)
-        fetch_count = 0
-        
-        self.logger.info(f"Starting sensor API monitor for {days} days")
-        self.logger.info(f"API URL: {self.api_url}")
-        self.logger.info(f"Interval: {interval_seconds} seconds")
-        self.logger.info(f"Start time: {start_time}")
-        self.logger.info(f"End time: {end_time}")
-        
+    def _writer_loop(self):
+        """Append queued rows to the CSV file in batches until close() is called"""
+        while True:
+            line = self._write_queue.get()
+            if line is None:
+                break
+            self._pending_rows.append(line)
+            if len(self._pending_rows) >= self._csv_flush_rows:
+                self._flush_rows()
+        self._flush_rows()
+    
+    def _flush_rows(self):
+        """Append buffered rows to the CSV file"""
+        if not self._pending_rows:
+            return
         try:
-            while datetime.now() < end_time:
-                fetch_start = time.time()
-                
-                # Fetch sensor data from API
-                data = self.fetch_sensor_data()
-                if data:
-                    self.save_data(data)
-                
-                fetch_count += 1
-                
-                # Calculate sleep time
-                fetch_duration = time.time() - fetch_start
-                sleep_time = max(0, interval_seconds - fetch_duration)
-                
-                # Log progress every hour (120 fetches at 30-second intervals)
-                if fetch_count % 120 == 0:
-                    remaining_time = end_time - datetime.now()
-                    self.logger.info(f"Progress: {fetch_count} API calls completed. Time remaining: {remaining_time}")
+            os.write(self._fd, ''.join(self._pending_rows).encode('utf-8'))
+            self._pending_rows.clear()
+        except OSError as e:
+            self.logger.error(f"Error saving data: {e}")
+    
+    def close(self):
+        """Write any queued rows and close the CSV file"""
+        if self._closed:
+            return
+        self._closed = True
+        self._write_queue.put(None)
+        self._writer_thread.join()
+        os.close(self._fd)
+        self._fd = None
+    
+    async def run_for_duration(self, days: int = 7, interval_seconds: int = 30):
+        """Run the sensor monitor for specified duration"""
+        await run_concurrent([self], days=days, interval_seconds=interval_seconds)
+
+async def run_concurrent(monitors: List[SensorAPIMonitor], days: int = 7, interval_seconds: int = 30):
+    """Run several sensor monitors on a shared schedule, polling them in parallel"""
+    logger = logging.getLogger(__name__)
+    loop = asyncio.get_running_loop()
+    start_time = datetime.now()
+    end_time = start_time + timedelta(days=days)
+    fetch_count = 0
+    
+    logger.info(f"Starting sensor API monitor for {days} days")
+    logger.info(f"API URL: {monitors[0].api_url}")
+    logger.info(f"Specimens: {', '.join(monitor.form_data['i'] for monitor in monitors)}")
+    logger.info(f"Interval: {interval_seconds} seconds")
+    logger.info(f"Start time: {start_time}")
+    logger.info(f"End time: {end_time}")
+    
+    # Absolute schedule so samples stay on a fixed grid instead of drifting.
+    # The run length is tracked on the monotonic clock so clock steps can't end it early
+    next_deadline = time.monotonic()
+    end_mono = next_deadline + days * 86400
+    
+    # SIGTERM (systemd/container stop) wakes the loop immediately for a clean shutdown
+    stop = asyncio.Event()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+    except (NotImplementedError, RuntimeError):
+        pass  # Unsupported on Windows event loops and outside the main thread
+    
+    try:
+        while time.monotonic() < end_mono and not stop.is_set():
+            # Fetch every specimen concurrently without blocking the event loop
+            results = await asyncio.gather(
+                *(loop.run_in_executor(None, monitor.fetch_sensor_data) for monitor in monitors),
+                return_exceptions=True
+            )
+            for monitor, data in zip(monitors, results):
+                if isinstance(data, Exception):
+                    logger.error(f"Error fetching sensor data for {monitor.form_data['i']}: {data}")
+                elif data:
+                    monitor.save_data(data)
+            
+            fetch_count += len(monitors)
+            
+            next_deadline += interval_seconds
+            
+            # Log progress every hour (120 polls at 30-second intervals)
+            if fetch_count % (120 * len(monitors)) == 0 and logger.isEnabledFor(logging.INFO):
+                remaining_time = timedelta(seconds=int(end_mono - time.monotonic()))
+                logger.info("Progress: %s API calls completed. Time remaining: %s", fetch_count, remaining_time)
+            
+            # Sleep until next scheduled fetch
+            sleep_time = next_deadline - time.monotonic()
+            if sleep_time > 0:
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=sleep_time)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                # Fell behind schedule, resync from now
+                next_deadline = time.monotonic()
                 
-                # Sleep until next fetch
-                if sleep_time > 0:
-                    time.sleep(sleep_time)
-                    
-        except KeyboardInterrupt:
-            self.logger.info("Monitoring interrupted by user")
-        except Exception as e:
-            self.logger.error(f"Unexpected error: {e}")
-        finally:
-            self.logger.info(f"Monitoring completed. Total API calls: {fetch_count}")
-            self.logger.info(f"Data saved to: {self.output_file}")
+    except KeyboardInterrupt:
+        logger.info("Monitoring interrupted by user")
+    except asyncio.CancelledError:
+        # Log, then propagate so callers that cancel the task see it cancelled
+        logger.info("Monitoring cancelled")
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}")
+    finally:
+        if stop.is_set():
+            logger.info("Monitoring stopped by SIGTERM")
+        try:
+            loop.remove_signal_handler(signal.SIGTERM)
+        except (NotImplementedError, RuntimeError):
+            pass
+        for monitor in monitors:
+            monitor.close()
+        logger.info(f"Monitoring completed. Total API calls: {fetch_count}")
+        logger.info(f"Data saved to: {', '.join(monitor.output_file for monitor in monitors)}")
 
 def main():
     # Create and run the sensor monitor
     # Original specimen length: 50mm
     monitor = SensorAPIMonitor("sensor_data.csv", original_length_mm=50.0)
-    monitor.run_for_duration(days=7, interval_seconds=30)
+    try:
+        asyncio.run(monitor.run_for_duration(days=7, interval_seconds=30))
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == "__main__":
     main()
\ No newline at end of file